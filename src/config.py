@@ -1,3 +1,5 @@
+import os
+
 GCP_PROJECT = "fashion-aggregator"
 GCS_STORAGE = "fa-data-scraped"
 
@@ -7,8 +9,37 @@ SITE_NAME = "vinted"
 
 DRIVER_PATH = "/opt/chromedriver"
 BINARY_PATH = "/opt/chrome-linux/chrome"
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg",
+    "*.woff", "*.woff2", "*.ttf",
+    "*google-analytics*", "*googletagmanager*", "*doubleclick*",
+]
+# Desktop Chrome user agents close to the bundled Chrome version, one is picked per driver
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/108.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/110.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36",
+)
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 HOME_URL = "https://www.vinted.cz/"
 WAIT = 10
 CATEGORY_CHOICES = ["zeny", "muzi"]
+OUTPUT_BUFFER_SIZE = 64 * 1024  # bytes buffered by the item url writer
+URL_FILTER_CAPACITY = 100_000  # urls per category before the bloom filter grows
+URL_FILTER_ERROR_RATE = 1e-4
+# Parallel image downloads, lower it on Lambdas with few vCPUs
+DOWNLOAD_MAX_WORKERS = int(os.environ.get("DOWNLOAD_MAX_WORKERS", 8))
+# Requests in flight of the async image downloads, a single event loop handles them all
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 128))
+# Image existence of up to this many urls is checked one by one concurrently, more urls list whole directories
+IMG_EXISTS_MAX_CHECKS = 1000
+IMG_EXISTS_MAX_WORKERS = 32
 ITEM_DATA_ALL = f"data/item_data/{SITE_NAME}/data/item_data_all.jsonl"
@@ -1,22 +1,64 @@
+import asyncio
+import atexit
 import datetime
 import logging
 import os
 import pathlib
-import shutil
+from logging.handlers import QueueListener
+from typing import TYPE_CHECKING
 
 from src.config import SITE_NAME
-from src.scrape_item_urls import scrape_item_urls
-from src.scraping import (close_cookies_and_country_button,
-                          setup_driver_for_docker)
-from src.utils import remove_duplicate_urls_from_file, s3_upload_file
+
+# Selenium, boto3 and google-cloud are imported inside the handlers which need them,
+# so a cold start of a lightweight handler (e.g. handler_index) does not pay for them
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 logger = logging.getLogger(__name__)
 
 
-def setup_driver():
-    driver = setup_driver_for_docker()
-    close_cookies_and_country_button(driver)
-    return driver
+# Chrome is kept running between invocations while the Lambda container stays warm
+_DRIVER = None
+
+
+def setup_driver() -> "webdriver.Chrome":
+    """Return driver with passed cookies and country selection, started only if there is no live one"""
+    from selenium.common.exceptions import WebDriverException
+
+    from src.scraping import (close_cookies_and_country_button,
+                              setup_driver_for_docker)
+
+    global _DRIVER
+    if _DRIVER is not None:
+        try:
+            _DRIVER.current_url  # fails if the browser is gone
+            return _DRIVER
+        except WebDriverException as E:
+            logger.warning(f"Cached driver is not responding, starting a new one! {E}")
+            quit_driver()
+    _DRIVER = setup_driver_for_docker()
+    try:
+        close_cookies_and_country_button(_DRIVER)
+    except Exception:
+        quit_driver()
+        raise
+    return _DRIVER
+
+
+def quit_driver() -> None:
+    """Quit the cached driver, so the next invocation starts a fresh one"""
+    global _DRIVER
+    if _DRIVER is None:
+        return
+    try:
+        _DRIVER.quit()
+    except Exception as E:
+        logger.warning(f"Driver was not quit! {E}")
+    finally:
+        _DRIVER = None
+
+
+atexit.register(quit_driver)
 
 
 class Args:
@@ -24,10 +66,12 @@ class Args:
     def __init__(self):
         self.categories = ["zeny", "muzi"]
         self.max_pages = 3
+        self.max_concurrency = 2
         self.output_dir = "/tmp/data"
         self.output_file = f"item_urls_{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')}.txt"
         self.save_to_gcs = False
         self.save_to_s3 = True
+        self.use_selenium = False
         self.clean_local_data = True
         self.debug = True
 
@@ -39,10 +83,16 @@ def handler_index(event=None, context=None) -> str:
 
 def handler_status(event=None, context=None) -> str:
     driver = setup_driver()
-    return f"{driver.title} - {driver.current_url} - {driver.session_id}"
+    try:
+        return f"{driver.title} - {driver.current_url} - {driver.session_id}"
+    except Exception:
+        quit_driver()
+        raise
 
 
 def handler_scrape_item_urls(event=None, context=None) -> str:
+    from src.utils import flush_logging, setup_logging
+
     driver = setup_driver()
     args = Args()
 
@@ -50,56 +100,54 @@ def handler_scrape_item_urls(event=None, context=None) -> str:
     log_filepath = f"/tmp/logs/{SITE_NAME}/{args.output_file.replace('.txt', '.log')}"
     pathlib.Path(f"/tmp/logs/{SITE_NAME}").mkdir(parents=True, exist_ok=True)
 
-    # https://stackoverflow.com/questions/37703609/using-python-logging-with-aws-lambda
-    if len(logging.getLogger().handlers) > 0:
-        # The Lambda environment pre-configures a handler logging to stderr. If a handler is already configured,
-        # `.basicConfig` does not execute. Thus we set the level directly.
-        logging.getLogger().setLevel(logging.INFO)
-        logging.getLogger().addHandler(logging.StreamHandler())
-        logging.getLogger().addHandler(logging.FileHandler(log_filepath))
-    else:
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-            handlers=[
-                logging.FileHandler(log_filepath),
-                logging.StreamHandler(),
-            ],
-        )
-
-    start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    listener = setup_logging(log_filepath)
+    try:
+        return scrape_and_upload_item_urls(args, driver, log_filepath, listener)
+    except Exception:
+        quit_driver()
+        raise
+    finally:
+        # Logging stays configured for the next warm invocation, only the records are written out
+        flush_logging(listener)
+
+
+def scrape_and_upload_item_urls(
+    args: Args, driver: "webdriver.Chrome", log_filepath: str, listener: QueueListener
+) -> str:
+    """Scrape item urls, upload them together with the log to S3 and clean up local data"""
+    from src.scrape_item_urls import scrape_item_urls
+    from src.utils import flush_logging, remove_directory, s3_upload_files
+
+    start_datetime = datetime.datetime.now()
+    start_time = start_datetime.strftime("%Y-%m-%d %H:%M:%S")
     logger.info(f"Started at {start_time}")
     if args.debug:
         logger.info("Running in a debug mode")
     args_str = "\n".join(["\t{}: {}".format(k, v) for k, v in vars(args).items()])
     logger.info(f"Given arguments:\n{args_str}")
 
-    scrape_item_urls(args, driver)
-
-    # Deduplicate the urls
-    logger.info("Removing duplicates from scraped item urls")
-    for category in args.categories:
-        url_filepath = os.path.join(args.output_dir, "item_urls", SITE_NAME, category, args.output_file)
-        remove_duplicate_urls_from_file(url_filepath)
+    asyncio.run(scrape_item_urls(args, driver))
 
     # Save data to S3
     if args.save_to_s3:
         logger.info("Uploading log and item urls to S3")
-        s3_upload_file(log_filepath, log_filepath.replace('/tmp/', ''))  # save log
+        files = [(log_filepath, log_filepath.replace('/tmp/', ''))]  # save log
         for category in args.categories:
             url_filepath = os.path.join(args.output_dir, "item_urls", SITE_NAME, category, args.output_file)
-            s3_upload_file(url_filepath, url_filepath.replace('/tmp/', ''))
+            files.append((url_filepath, url_filepath.replace('/tmp/', '')))
+        flush_logging(listener)
+        s3_upload_files(files)
 
     # Remove local data
     if args.clean_local_data:
         logger.info("Cleaning local data - removing log and item scraped item url data")
-        shutil.rmtree("/tmp/logs")
-        shutil.rmtree(args.output_dir)
+        remove_directory("/tmp/logs")
+        remove_directory(args.output_dir)
         logger.info("Local data removed")
 
-    end_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    run_time = {datetime.datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S') - datetime.datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')}  # noqa
+    end_datetime = datetime.datetime.now()
+    end_time = end_datetime.strftime("%Y-%m-%d %H:%M:%S")
+    run_time = end_datetime - start_datetime
     result_message = (
         f"{SITE_NAME} item_urls for {args.categories} categories were scraped.",
         f"It took {run_time}.",
@@ -1,67 +1,162 @@
 import argparse
+import asyncio
 import datetime
 import logging
 import os
 import pathlib
-import shutil
 import time
-from random import randint
-from typing import Any, Dict, Union
+from concurrent.futures import ThreadPoolExecutor
+from random import randint, uniform
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, List, Set, Tuple, Union
 
-from selenium import webdriver
-from src.config import CATEGORY_CHOICES, HOME_URL, SITE_NAME
+import httpx
+from pybloom_live import ScalableBloomFilter
+
+from src.config import (CATEGORY_CHOICES, HOME_URL, OUTPUT_BUFFER_SIZE,
+                        SITE_NAME)
 from src.scraping import (click_to_country_button,
                           click_to_reject_all_cookies_button,
                           cookies_button_present, country_button_present,
-                          get_item_urls_from_page, get_next_page_button,
-                          setup_driver, setup_driver_for_docker)
-from src.utils import (append_urls_to_file, construct_starting_urls,
-                       gcs_upload_file, remove_duplicate_urls_from_file,
-                       s3_upload_file)
+                          get_item_urls_from_html, get_item_urls_from_page,
+                          get_page_html, get_page_url, get_total_pages,
+                          get_total_pages_from_html, setup_driver,
+                          setup_driver_for_docker, setup_http_client)
+from src.utils import (append_urls_to_stream, construct_starting_urls,
+                       filter_new_urls, flush_logging, gcs_upload_file,
+                       read_url_filter_from_file, remove_directory,
+                       s3_upload_files, setup_logging, teardown_logging)
+
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 # Setup module logger
 # https://stackoverflow.com/questions/22231809/is-it-better-to-use-root-logger-or-named-logger-in-python
 logger = logging.getLogger(__name__)
 
 
-def scrape_item_urls(args: Union[Dict[str, Any], argparse.Namespace], driver: webdriver) -> None:
-    """Function that scrapes all the pages"""
+async def scrape_item_urls(
+    args: Union[Dict[str, Any], argparse.Namespace], driver: "webdriver.Chrome"
+) -> None:
+    """Function that scrapes all the pages, categories are scraped concurrently"""
     max_pages = args.max_pages if hasattr(args, "max_pages") and args.max_pages else 1000  # TODO float("inf")
     starting_urls = construct_starting_urls(args)
     logger.info(f"Starting urls {starting_urls}")
-    for category, starting_url in zip(args.categories, starting_urls):
-        logger.info(f"Scraping {category} starting with {starting_url}")
+    output_filepaths, seen_urls = [], []
+    for category in args.categories:
         # Prepare filepath and directories if not exist
         output_filepath = os.path.join(args.output_dir, "item_urls", SITE_NAME, category, args.output_file)
-        output_filepath_parent = pathlib.Path(output_filepath).parent
-        output_filepath_parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(output_filepath).parent.mkdir(parents=True, exist_ok=True)
+        output_filepaths.append(output_filepath)
+        # Urls already saved by a previous run into the same file are not written again
+        seen_urls.append(read_url_filter_from_file(output_filepath))
+
+    if getattr(args, "use_selenium", False):
+        # Single browser, so the categories are scraped one by one
+        for category, starting_url, output_filepath, seen in zip(
+            args.categories, starting_urls, output_filepaths, seen_urls
+        ):
+            scrape_category_with_driver(driver, category, starting_url, output_filepath, seen, max_pages)
+        return
+
+    semaphore = asyncio.Semaphore(getattr(args, "max_concurrency", 2))
+    async with setup_http_client(driver) as client:
+        await asyncio.gather(
+            *[
+                scrape_category_with_client(client, semaphore, category, starting_url, output_filepath, seen, max_pages)
+                for category, starting_url, output_filepath, seen in zip(
+                    args.categories, starting_urls, output_filepaths, seen_urls
+                )
+            ]
+        )
+
+
+def save_new_urls(urls: Set[str], seen_urls: ScalableBloomFilter, fw: BinaryIO) -> List[str]:
+    """Write urls which were not seen yet into the file and return them"""
+    new_urls = filter_new_urls(urls, seen_urls)
+    append_urls_to_stream(fw, new_urls)
+    return new_urls
+
 
-        driver.get(starting_url)
+def save_new_urls_from_html(html: bytes, seen_urls: ScalableBloomFilter, fw: BinaryIO) -> Tuple[Set[str], List[str]]:
+    """Write item urls from the page html which were not seen yet into the file, return all and new urls"""
+    page_urls = get_item_urls_from_html(html)
+    return page_urls, save_new_urls(page_urls, seen_urls, fw)
 
-        next_page_button, current_page = True, 1
-        while next_page_button and current_page <= max_pages:
+
+async def scrape_category_with_client(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    category: str,
+    starting_url: str,
+    output_filepath: str,
+    seen_urls: ScalableBloomFilter,
+    max_pages: int,
+) -> int:
+    """Scrape item urls of a category page by page over plain HTTP, return the last scraped page"""
+    logger.info(f"Scraping {category} starting with {starting_url}")
+    with open(output_filepath, "ab", buffering=OUTPUT_BUFFER_SIZE) as fw:
+        # The number of pages is known from the first one, the rest is requested directly by url
+        html = await get_page_html(client, semaphore, get_page_url(starting_url, 1))
+        last_page = min(get_total_pages_from_html(html), max_pages)
+        logger.info(f"Scraping {last_page} pages of {category}")
+        for current_page in range(1, last_page + 1):
             # Scrape item urls
             logger.info(f"Scraping page {current_page} of {category}")
-            page_urls = set(get_item_urls_from_page(driver))
-            logger.info(f"Scraped {len(page_urls)} urls for page {current_page}")
-            time.sleep(randint(3, 5))
+            if current_page > 1:
+                html = await get_page_html(client, semaphore, get_page_url(starting_url, current_page))
 
-            # Save into file
-            append_urls_to_file(output_filepath, page_urls)
+            # Parse and save the page in a thread while waiting before the next request
+            delay = uniform(3, 5) if current_page < last_page else 0
+            (page_urls, new_urls), _ = await asyncio.gather(
+                asyncio.to_thread(save_new_urls_from_html, html, seen_urls, fw),
+                asyncio.sleep(delay),
+            )
+            logger.info(f"Scraped {len(page_urls)} urls ({len(new_urls)} new) for page {current_page}")
             logger.info("Saved into file")
 
-            # Go to next page if available
-            next_page_button = get_next_page_button(driver)
-            if not next_page_button:
-                logger.info(f"There are no more pages. Current page is {current_page}.")
+    logger.info(
+        f"Scraping for {starting_url} finished at page {current_page}. Items were saved into {output_filepath}",
+    )
+    return current_page
+
+
+def scrape_category_with_driver(
+    driver: "webdriver.Chrome",
+    category: str,
+    starting_url: str,
+    output_filepath: str,
+    seen_urls: ScalableBloomFilter,
+    max_pages: int,
+) -> int:
+    """Scrape item urls of a category page by page in the browser, return the last scraped page"""
+    logger.info(f"Scraping {category} starting with {starting_url}")
+
+    with open(output_filepath, "ab", buffering=OUTPUT_BUFFER_SIZE) as fw, ThreadPoolExecutor(max_workers=1) as executor:
+        last_page = max_pages  # the number of pages is known once the first one is loaded
+        for current_page in range(1, max_pages + 1):
+            # Scrape item urls
+            logger.info(f"Scraping page {current_page} of {category}")
+            driver.get(get_page_url(starting_url, current_page))
+            page_urls = get_item_urls_from_page(driver)
+            if current_page == 1:
+                last_page = min(get_total_pages(driver), max_pages)
+                logger.info(f"Scraping {last_page} pages of {category}")
+
+            # Save the page in a thread while waiting before the next request
+            saving = executor.submit(save_new_urls, page_urls, seen_urls, fw)
+            if current_page < last_page:
+                time.sleep(randint(3, 5))
+            new_urls = saving.result()
+            logger.info(f"Scraped {len(page_urls)} urls ({len(new_urls)} new) for page {current_page}")
+            logger.info("Saved into file")
+
+            if current_page == last_page:
                 break
-            next_page_button.click()
-            current_page += 1
-            time.sleep(randint(3, 5))
 
-        logger.info(
-            f"Scraping for {starting_url} finished at page {current_page}. Items were saved into {output_filepath}",
-        )
+    logger.info(
+        f"Scraping for {starting_url} finished at page {current_page}. Items were saved into {output_filepath}",
+    )
+    return current_page
 
 
 def main():
@@ -100,6 +195,13 @@ def main():
         default=False,
         help="If True, then scraped data are saved on GCS.",
     )
+    parser.add_argument(
+        "--save-to-s3",
+        action="store_true",
+        dest="save_to_s3",
+        default=False,
+        help="If True, then scraped data are saved on S3.",
+    )
     parser.add_argument(
         "--clean-local-data",
         action="store_true",
@@ -114,6 +216,20 @@ def main():
         default=False,
         help="If True, then only a tiny part of the website is scraped.",
     )
+    parser.add_argument(
+        "--max-concurrency",
+        dest="max_concurrency",
+        type=int,
+        default=2,
+        help="Max number of pages fetched at the same time.",
+    )
+    parser.add_argument(
+        "--use-selenium",
+        action="store_true",
+        dest="use_selenium",
+        default=False,
+        help="If True, then pages are scraped in the browser instead of over plain HTTP.",
+    )
     parser.add_argument(
         "--in-docker",
         action="store_true",
@@ -131,16 +247,9 @@ def main():
     # Setup logger
     log_filepath = f"logs/{SITE_NAME}/{args.output_file.replace('.txt', '.log')}"
     pathlib.Path(f"logs/{SITE_NAME}").mkdir(parents=True, exist_ok=True)
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[
-            logging.FileHandler(log_filepath),
-            logging.StreamHandler(),
-        ],
-    )
-    start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    listener = setup_logging(log_filepath)
+    start_datetime = datetime.datetime.now()
+    start_time = start_datetime.strftime("%Y-%m-%d %H:%M:%S")
     logger.info(f"Started at {start_time}")
     if args.debug:
         logger.info("Running in a debug mode")
@@ -152,7 +261,6 @@ def main():
         driver = setup_driver_for_docker() if args.in_docker else setup_driver()
         # Go to home url, choose country and reject all cookies
         driver.get(HOME_URL)
-        time.sleep(3)
         if country_button_present(driver):
             logger.info("Passing country selection")
             click_to_country_button(driver)
@@ -160,21 +268,16 @@ def main():
         if cookies_button_present(driver):
             logger.info("Passing cookies selection")
             click_to_reject_all_cookies_button(driver)
-        scrape_item_urls(args, driver)
+        asyncio.run(scrape_item_urls(args, driver))
     finally:
         # Close webdriver
         driver.close()
         driver.quit()
 
-    # Deduplicate the urls
-    logger.info("Removing duplicates from scraped item urls")
-    for category in args.categories:
-        url_filepath = os.path.join(args.output_dir, "item_urls", SITE_NAME, category, args.output_file)
-        remove_duplicate_urls_from_file(url_filepath)
-
     # Save data to GCS
     if args.save_to_gcs:
         logger.info("Uploading log and item urls to GCS")
+        flush_logging(listener)
         gcs_upload_file(log_filepath, log_filepath)  # save log
         for category in args.categories:
             url_filepath = os.path.join(args.output_dir, "item_urls", SITE_NAME, category, args.output_file)
@@ -183,26 +286,30 @@ def main():
     # Save data to S3
     if args.save_to_s3:
         logger.info("Uploading log and item urls to S3")
-        s3_upload_file(log_filepath, log_filepath)  # save log
+        files = [(log_filepath, log_filepath)]  # save log
         for category in args.categories:
             url_filepath = os.path.join(args.output_dir, "item_urls", SITE_NAME, category, args.output_file)
-            s3_upload_file(url_filepath, url_filepath)
+            files.append((url_filepath, url_filepath))
+        flush_logging(listener)
+        s3_upload_files(files)
 
     # Remove local data
     if args.clean_local_data:
         logger.info("Cleaning local data - removing log and item scraped item url data")
-        shutil.rmtree("logs")
-        shutil.rmtree(args.output_dir)
+        remove_directory("logs")
+        remove_directory(args.output_dir)
         logger.info("Local data removed")
 
-    end_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    run_time = {datetime.datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S') - datetime.datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')}  # noqa
+    end_datetime = datetime.datetime.now()
+    end_time = end_datetime.strftime("%Y-%m-%d %H:%M:%S")
+    run_time = end_datetime - start_datetime
     result_message = (
         f"{SITE_NAME} item_urls for {args.categories} categories were scraped.",
         f"It took {run_time}.",
         f"Start time {start_time} - end time {end_time}."
     )
     logger.info(result_message)
+    teardown_logging(listener)
 
 
 if __name__ == "__main__":
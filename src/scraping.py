@@ -1,34 +1,50 @@
+import asyncio
 import logging
 import time
-from random import randint
-from typing import List, Optional, Set
+import urllib.parse
+from random import choice, randint
+from typing import TYPE_CHECKING, List, Set
 
-from fake_useragent import UserAgent
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.remote.webelement import WebElement
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
+import httpx
+import lxml.html
+from lxml.cssselect import CSSSelector
 
-from selenium import webdriver
-from src.config import BINARY_PATH, DRIVER_PATH, HOME_URL, WAIT
+from src.config import (BINARY_PATH, BLOCKED_URL_PATTERNS, DRIVER_PATH,
+                        HOME_URL, USER_AGENTS, WAIT)
+
+# Selenium is imported by the functions using it, so the HTTP scraping path does not load it
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 # Setup module logger
 logger = logging.getLogger(__name__)
 
+# Selectors are built once and shared by all the calls
+ITEM_LINK_SELECTOR = "div.feed-grid__item a.new-item-box__overlay[href]"
+PAGINATION_ITEM_SELECTOR = "a[class*='Pagination__item']"
+COOKIES_BUTTON_SELECTOR = "[id^='onetrust-reject-all-handler']"
+COUNTRY_BUTTON_SELECTOR = "[class*='web_ui__Cell__cell web_ui__Cell__default web_ui__Cell__clickable']"
+ITEM_LINK_CSS = CSSSelector(ITEM_LINK_SELECTOR)
+PAGINATION_ITEM_CSS = CSSSelector(PAGINATION_ITEM_SELECTOR)
+COUNTRY_BUTTON_WAIT = 5  # seconds to wait for the country modal to appear
+
 
-def setup_driver() -> webdriver:
+def setup_driver() -> "webdriver.Chrome":
     """Setup Selenium Chrome driver open HOME_URL defined in config and reject all cookies"""
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+
     options = webdriver.ChromeOptions()
     options.binary_location = BINARY_PATH
     service = Service(DRIVER_PATH)
     driver = webdriver.Chrome(service=service, options=options)
-    driver.implicitly_wait(5)
     return driver
 
 
-def setup_driver_options_for_docker() -> webdriver.ChromeOptions:
+def setup_driver_options_for_docker() -> "webdriver.ChromeOptions":
     """Setup driver options for headless Chrome in Docker container"""
+    from selenium import webdriver
+
     chrome_options = webdriver.ChromeOptions()
     chrome_options.binary_location = BINARY_PATH
     chrome_options.add_argument("--headless")  # Hide the GUI
@@ -38,23 +54,34 @@ def setup_driver_options_for_docker() -> webdriver.ChromeOptions:
     chrome_options.add_argument("--no-zygote")  # Don't create zygote processes because Lambda give us only one CPU
     chrome_options.add_argument("--disable-dev-shm-usage")  # Create temporary folder for shared memory files
     chrome_options.add_argument("--disable-dev-tools")  # Disable Chrome dev tools
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")  # Item urls do not need any images
+    chrome_options.add_experimental_option(
+        "prefs",
+        {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.default_content_setting_values.notifications": 2,
+        },
+    )
 
-    ua = UserAgent(browsers=["chrome"])
-    user_agent = ua.random
-    chrome_options.add_argument(f"user-agent={user_agent}")
+    chrome_options.add_argument(f"user-agent={choice(USER_AGENTS)}")
     return chrome_options
 
 
-def setup_driver_for_docker() -> webdriver:
+def setup_driver_for_docker() -> "webdriver.Chrome":
     """Setup Selenium Chrome driver for headless Chrome in Docker container"""
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+
     chrome_options = setup_driver_options_for_docker()
     service = Service(DRIVER_PATH)
     driver = webdriver.Chrome(service=service, options=chrome_options)
-    driver.implicitly_wait(5)
+    # Skip downloading images, fonts and trackers which are irrelevant for scraping
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
     return driver
 
 
-def close_cookies_and_country_button(driver: webdriver) -> None:
+def close_cookies_and_country_button(driver: "webdriver.Chrome") -> None:
     """Go to home url and reject all cookies"""
     driver.get(HOME_URL)
     if country_button_present(driver):
@@ -64,74 +91,134 @@ def close_cookies_and_country_button(driver: webdriver) -> None:
         click_to_reject_all_cookies_button(driver)
 
 
-def get_item_urls_from_page(driver: webdriver) -> Set[str]:
+def get_item_urls_from_page(driver: "webdriver.Chrome") -> Set[str]:
     """Return all urls of items from a page"""
+    from selenium.webdriver.support.ui import WebDriverWait
+
     return_urls = set()
     try:
-        WebDriverWait(driver, WAIT).until(
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[class=feed-grid__item] a[href]"))
+        # Wait until the links are present and read all their hrefs within a single script call
+        links = WebDriverWait(driver, WAIT).until(
+            lambda d: d.execute_script(
+                "return Array.from(document.querySelectorAll(arguments[0])).map(a => a.href);",
+                ITEM_LINK_SELECTOR,
+            )
         )
-        # There are supposed to be an even number of links.
-        # Each item needs to have 2 links (1 for seller and 1 for item)
+        logger.info(f"Found {len(links)} links")
+        return_urls = set(map(str, links))
+    except Exception as E:
+        logger.warning(f"Items were not returned! {E}")
+    finally:
+        return return_urls
+
+
+def setup_http_client(driver: "webdriver.Chrome") -> httpx.AsyncClient:
+    """Setup async HTTP client sharing cookies and user agent with the driver, so the interstitials stay passed"""
+    cookies = httpx.Cookies()
+    for cookie in driver.get_cookies():
+        cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+    user_agent = driver.execute_script("return navigator.userAgent")
+    return httpx.AsyncClient(cookies=cookies, headers={"User-Agent": user_agent}, timeout=WAIT, follow_redirects=True)
+
+
+async def get_page_html(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, url: str) -> bytes:
+    """Return html of a page, empty bytes if the page could not be fetched"""
+    try:
+        async with semaphore:
+            response = await client.get(url)
+        response.raise_for_status()
+        return response.content
+    except Exception as E:
+        logger.warning(f"Page {url} was not fetched! {E}")
+        return b""
+
+
+def get_item_urls_from_html(html: bytes) -> Set[str]:
+    """Return all urls of items from a page html"""
+    return_urls = set()
+    try:
         links = [
-            link.get_attribute("href")
-            for link in driver.find_elements(by=By.CSS_SELECTOR, value="div[class=feed-grid__item] a[href]")
+            urllib.parse.urljoin(HOME_URL, link.get("href"))
+            for link in ITEM_LINK_CSS(lxml.html.fromstring(html))
         ]
-        num_of_links = len(links)
-        logger.info(f"Found {num_of_links} links")
-        if num_of_links % 2 == 0:
-            return_urls = set(map(str, links[1::2]))
+        logger.info(f"Found {len(links)} links")
+        return_urls = set(links)
     except Exception as E:
         logger.warning(f"Items were not returned! {E}")
     finally:
         return return_urls
 
 
-def get_next_page_button(driver: webdriver) -> Optional[WebElement]:
-    """Return clickable WebElement if the current page is not the last one"""
-    button_element = None
+def get_total_pages_from_html(html: bytes) -> int:
+    """Return number of pages of the listing given by the highest page number in the page html pagination"""
     try:
-        WebDriverWait(driver, WAIT).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "a[class*='Pagination__next']")))
-        button_element = driver.find_element(By.CSS_SELECTOR, "a[class*='Pagination__next']")
+        page_numbers = [link.text_content().strip() for link in PAGINATION_ITEM_CSS(lxml.html.fromstring(html))]
+        return max([int(page_number) for page_number in page_numbers if page_number.isdigit()], default=1)
     except Exception as E:
-        logger.warning(f"Button was not found! {E}")
-    finally:
-        return button_element
+        logger.warning(f"Number of pages was not found! {E}")
+        return 1
 
 
-def cookies_button_present(driver: webdriver) -> bool:
-    """Check whether the cookies button is present on the website"""
-    if driver.find_elements(By.CSS_SELECTOR, "[id^='onetrust-reject-all-handler']"):
-        return True
-    return False
+def get_page_url(starting_url: str, page: int) -> str:
+    """Construct url of a given page of the listing"""
+    return f"{starting_url}?page={page}"
 
 
-def click_to_reject_all_cookies_button(driver: webdriver) -> None:
-    """Click on the reject all cookies button, so the next page button is clickable"""
+def get_total_pages(driver: "webdriver.Chrome") -> int:
+    """Return number of pages of the listing given by the highest page number in the pagination"""
+    try:
+        page_numbers = driver.execute_script(
+            "return Array.from(document.querySelectorAll(arguments[0])).map(a => a.innerText.trim());",
+            PAGINATION_ITEM_SELECTOR,
+        )
+        return max([int(page_number) for page_number in page_numbers if page_number.isdigit()], default=1)
+    except Exception as E:
+        logger.warning(f"Number of pages was not found! {E}")
+        return 1
+
+
+def element_present(driver: "webdriver.Chrome", css_selector: str, timeout: float = 0) -> bool:
+    """Check whether an element given by css selector is present on the website, waiting up to timeout seconds"""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support.ui import WebDriverWait
+
     try:
-        WebDriverWait(driver, WAIT).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, "[id^='onetrust-reject-all-handler']"))
+        return WebDriverWait(driver, timeout).until(
+            lambda d: d.execute_script("return !!document.querySelector(arguments[0]);", css_selector)
         )
-        driver.find_element(By.CSS_SELECTOR, "[id^='onetrust-reject-all-handler']").click()
+    except TimeoutException:
+        return False
+
+
+def cookies_button_present(driver: "webdriver.Chrome") -> bool:
+    """Check whether the cookies button is present on the website, the banner is rendered during the sleep before"""
+    return element_present(driver, COOKIES_BUTTON_SELECTOR)
+
+
+def click_to_reject_all_cookies_button(driver: "webdriver.Chrome") -> None:
+    """Click on the reject all cookies button, so the next page button is clickable"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    try:
+        locator = (By.CSS_SELECTOR, COOKIES_BUTTON_SELECTOR)
+        WebDriverWait(driver, WAIT).until(EC.element_to_be_clickable(locator)).click()
     except Exception as E:
         logger.warning(f"Button to reject all cookies was not found! {E}")
 
 
-def country_button_present(driver: webdriver) -> bool:
-    """Check whether the country button is present on the website"""
-    if driver.find_elements(
-        By.CSS_SELECTOR, "[class*='web_ui__Cell__cell web_ui__Cell__default web_ui__Cell__clickable']"
-    ):
-        return True
-    return False
+def country_button_present(driver: "webdriver.Chrome") -> bool:
+    """Check whether the country button is present on the website, the modal is rendered after the page loads"""
+    return element_present(driver, COUNTRY_BUTTON_SELECTOR, timeout=COUNTRY_BUTTON_WAIT)
 
 
-def click_to_country_button(driver: webdriver, country: str = "Česká republika") -> None:
+def click_to_country_button(driver: "webdriver.Chrome", country: str = "Česká republika") -> None:
     """Click on the Czech location button, so the next page button is clickable"""
+    from selenium.webdriver.common.by import By
+
     try:
-        countries = driver.find_elements(
-            By.CSS_SELECTOR, "[class*='web_ui__Cell__cell web_ui__Cell__default web_ui__Cell__clickable']"
-        )
+        countries = driver.find_elements(By.CSS_SELECTOR, COUNTRY_BUTTON_SELECTOR)
         for i, country_choice in enumerate(countries):
             if country_choice.text == country:
                 countries[i].click()
@@ -141,8 +228,12 @@ def click_to_country_button(driver: webdriver, country: str = "Česká republika
         logger.warning(f"Button to choose country was not found! {E}")
 
 
-def scrape_element(driver: webdriver, css_selector: By.CSS_SELECTOR) -> str:
+def scrape_element(driver: "webdriver.Chrome", css_selector: str) -> str:
     """Scrape a single element given by css selector that will be converted to text"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
     el_value = ""
     try:
         WebDriverWait(driver, WAIT).until(EC.presence_of_element_located((By.CSS_SELECTOR, css_selector)))
@@ -153,8 +244,12 @@ def scrape_element(driver: webdriver, css_selector: By.CSS_SELECTOR) -> str:
         return el_value
 
 
-def scrape_elements(driver: webdriver, css_selector: By.CSS_SELECTOR) -> List[str]:
+def scrape_elements(driver: "webdriver.Chrome", css_selector: str) -> List[str]:
     """Scrape elements given by css selector that will be converted to text"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
     el_values = []
     try:
         WebDriverWait(driver, WAIT).until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, css_selector)))
@@ -165,8 +260,12 @@ def scrape_elements(driver: webdriver, css_selector: By.CSS_SELECTOR) -> List[st
         return el_values
 
 
-def scrape_image_urls(driver: webdriver, css_selector: By.CSS_SELECTOR) -> None:
+def scrape_image_urls(driver: "webdriver.Chrome", css_selector: str) -> None:
     """Scrape images urls given by css selector"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
     img_urls = []
     try:
         WebDriverWait(driver, WAIT).until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, css_selector)))
@@ -1,59 +1,425 @@
 import argparse
+import asyncio
 import json
 import logging
+import mmap
 import os
 import posixpath
+import queue
+import re
+import threading
 import urllib.parse
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed)
+from functools import lru_cache, partial
 from io import BytesIO
-from typing import Dict, List, Set, Union
+from itertools import chain
+from logging.handlers import BufferingHandler, QueueHandler, QueueListener
+from typing import (BinaryIO, Dict, FrozenSet, Iterable, Iterator, List,
+                    Optional, Set, Tuple, Union)
 
 import boto3
+import httpx
 import requests
+import xxhash
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 from google.cloud import storage
 from PIL import Image
+from pybloom_live import ScalableBloomFilter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from src.config import (GCP_PROJECT, GCS_STORAGE, HOME_URL, ITEM_DATA_ALL,
-                        S3_BUCKET)
+from src.config import (DOWNLOAD_CONCURRENCY, DOWNLOAD_MAX_WORKERS,
+                        GCP_PROJECT, GCS_STORAGE, HOME_URL,
+                        IMG_EXISTS_MAX_CHECKS, IMG_EXISTS_MAX_WORKERS,
+                        ITEM_DATA_ALL, LOG_DATE_FORMAT, LOG_FORMAT, S3_BUCKET,
+                        URL_FILTER_CAPACITY, URL_FILTER_ERROR_RATE, WAIT)
 
 # Setup module logger
 logger = logging.getLogger(__name__)
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IMG_CONTENT_TYPE_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+# Metadata key of the uploaded images holding ETag of the image they were downloaded from
+SOURCE_ETAG_KEY = "source-etag"
+ITEM_ID_PATTERN = re.compile(rb'"id"\s*:\s*"?([^",}\s]+)"?')
+
+# orjson is several times faster on the jsonl hot paths, stdlib json is the fallback
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(data: Dict[str, str]) -> str:
+        return orjson.dumps(data).decode("utf-8")
+
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(data: Dict[str, str]) -> str:
+        return json.dumps(data, ensure_ascii=False)
+
+
+# Logging
+class BatchFileHandler(BufferingHandler):
+    """Buffer log records and write them into a file in batches
+
+    The buffer is written out when it holds `capacity` records, when an ERROR (or worse) record arrives
+    and at the latest `flush_interval` seconds after the first record was buffered.
+    """
+
+    def __init__(self, filename: str, capacity: int = 1024, flush_interval: float = 30.0):
+        super().__init__(capacity)
+        self.file_handler = logging.FileHandler(filename)
+        self.flush_interval = flush_interval
+        self.timer = None
+
+    def shouldFlush(self, record: logging.LogRecord) -> bool:
+        return super().shouldFlush(record) or record.levelno >= logging.ERROR
+
+    def emit(self, record: logging.LogRecord) -> None:
+        super().emit(record)
+        if self.buffer and self.timer is None:
+            self.timer = threading.Timer(self.flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.buffer:
+                self.file_handler.stream.write("".join(f"{self.format(record)}\n" for record in self.buffer))
+                self.file_handler.flush()
+                self.buffer.clear()
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.file_handler.close()
+
+    def set_filename(self, filename: str) -> None:
+        """Write buffered records into the current file and the following ones into a given file"""
+        self.acquire()
+        try:
+            self.flush()
+            self.file_handler.close()
+            self.file_handler = logging.FileHandler(filename)
+        finally:
+            self.release()
+
+
+# Logging is configured once per process and reused by warm Lambda invocations
+_LOG_LISTENER = None
+
+
+def setup_logging(log_filepath: str) -> QueueListener:
+    """Log into a file and stderr from a background thread, so logging calls do not block on disk writes
+
+    Only the first call configures logging, later calls switch the log file, so handlers do not pile up.
+    """
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        flush_logging(_LOG_LISTENER)
+        for handler in _LOG_LISTENER.handlers:
+            if isinstance(handler, BatchFileHandler):
+                handler.set_filename(log_filepath)
+        return _LOG_LISTENER
+
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+    handlers = [BatchFileHandler(log_filepath), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers)
+    # The Lambda environment pre-configures a handler logging to stderr, so the level is set directly
+    # https://stackoverflow.com/questions/37703609/using-python-logging-with-aws-lambda
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    _LOG_LISTENER = listener
+    return listener
+
+
+def flush_logging(listener: QueueListener) -> None:
+    """Write out all queued and buffered log records, e.g. before the log file is uploaded"""
+    listener.stop()
+    for handler in listener.handlers:
+        handler.flush()
+    listener.start()
+
+
+def teardown_logging(listener: QueueListener) -> None:
+    """Write out queued log records, stop the listener and detach its queue from the root logger"""
+    global _LOG_LISTENER
+    listener.stop()
+    if listener is _LOG_LISTENER:
+        _LOG_LISTENER = None
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        if isinstance(handler, QueueHandler) and handler.queue is listener.queue:
+            root_logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.close()
+
 
 # File operations
 def append_urls_to_file(filepath: str, content: Union[List[str], Set[str]]) -> None:
     """Save list or set of urls into a given file. Single url per line."""
     with open(filepath, "a", encoding="utf-8") as fw:
-        fw.write("\n".join(content))
+        fw.writelines(f"{url}\n" for url in content)
+
+
+def append_urls_to_stream(fw: BinaryIO, content: Union[List[str], Set[str]]) -> None:
+    """Write list or set of urls into an opened binary file and flush it. Single url per line."""
+    if content:
+        fw.write(("\n".join(content) + "\n").encode("utf-8"))
+    fw.flush()
+
+
+def remove_directory(path: str, max_workers: int = 8) -> None:
+    """Remove a directory with all its content, files are unlinked in parallel"""
+    files, directories = [], [path]
+    for directory in directories:  # grows while walking, so all subdirectories are visited
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                else:
+                    files.append(entry.path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(os.unlink, files))
+    # Subdirectories come after their parents, so they are removed first
+    for directory in reversed(directories):
+        os.rmdir(directory)
+
+
+def iter_urls_from_file(filepath: str) -> Iterator[str]:
+    """Yield urls from a given file. Single url per line.
+
+    The file is memory-mapped, so only the pages being scanned are resident and no line list is built.
+    """
+    with open(filepath, "rb") as fr:
+        if os.fstat(fr.fileno()).st_size == 0:  # empty file can't be mapped
+            return
+        with mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, size = 0, len(mm)
+            while start < size:
+                end = mm.find(b"\n", start)
+                if end < 0:  # last line without newline
+                    end = size
+                yield mm[start:end].strip().decode("utf-8")
+                start = end + 1
 
 
 def read_urls_from_file(filepath: str) -> List[str]:
     """Read urls from a given file. Single url per line."""
     logger.info("Reading item_urls from local file.")
-    with open(filepath, "r", encoding="utf-8") as fr:
-        return [line.strip() for line in fr.readlines()]
+    return list(iter_urls_from_file(filepath))
+
+
+def read_url_filter_from_file(filepath: str) -> ScalableBloomFilter:
+    """Read urls from a given file into a bloom filter of seen urls, empty filter if the file does not exist yet"""
+    seen_urls = ScalableBloomFilter(initial_capacity=URL_FILTER_CAPACITY, error_rate=URL_FILTER_ERROR_RATE)
+    if os.path.exists(filepath):
+        for url in iter_urls_from_file(filepath):
+            if url:
+                seen_urls.add(canonicalize_url(url))
+    return seen_urls
 
 
 def append_json_to_jsonl_file(output_file: str, data: Dict[str, str]) -> None:
     """Append given data to the file"""
     with open(output_file, "a", encoding="utf-8") as fw:
-        fw.write(json.dumps(data, ensure_ascii=False) + "\n")
+        fw.write(json_dumps(data) + "\n")
+
+
+@lru_cache(maxsize=1)
+def http_session() -> requests.Session:
+    """Returns HTTP session with a keep-alive connection pool shared by the downloads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=DOWNLOAD_MAX_WORKERS,
+        pool_maxsize=DOWNLOAD_MAX_WORKERS,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 
+@lru_cache(maxsize=1)
+def image_encoding_executor() -> Executor:
+    """Returns process pool shared by the image encoding, thread pool where processes can't be spawned (AWS Lambda)"""
+    try:
+        return ProcessPoolExecutor(max_workers=os.cpu_count())
+    except OSError as E:  # Lambda has no /dev/shm for the multiprocessing locks
+        logger.warning(f"Process pool is not available, encoding images in threads: {E}")
+        return ThreadPoolExecutor(max_workers=os.cpu_count())
 
-def download_images(img_urls: List[str], filepath: str) -> None:
-    """Download images from list of urls"""
-    for i, img_url in enumerate(img_urls):
-        # Request the image and open it
-        r = requests.get(img_url)
-        img = Image.open(BytesIO(r.content))
-        # Save image
-        img.save(f"{filepath}_{i}.png")
 
+def image_needs_encoding(content: bytes, extension: Optional[str] = None) -> bool:
+    """Check whether downloaded image has to be re-encoded into png, images in a kept format or png do not"""
+    return extension is None and not content.startswith(PNG_SIGNATURE)
 
-def read_item_ids_from_jsonl(file: str) -> Set[str]:
+
+def encode_image(content: bytes, filepath: str) -> None:
+    """Decode downloaded image and save it (filepath without extension) as png"""
+    Image.open(BytesIO(content)).save(f"{filepath}.png", compress_level=3)
+
+
+def save_image(content: bytes, filepath: str, extension: Optional[str] = None) -> None:
+    """Save downloaded image (filepath without extension) as png, or as it is if its format extension is given
+
+    Images which already are png are written without re-encoding too.
+    """
+    if image_needs_encoding(content, extension):
+        encode_image(content, filepath)
+    else:
+        with open(f"{filepath}.{extension or 'png'}", "wb") as fw:
+            fw.write(content)
+
+
+def content_type_to_img_extension(content_type: str) -> Optional[str]:
+    """Returns extension of the image format kept as it is (png, jpg or webp), None for the other content types"""
+    return IMG_CONTENT_TYPE_EXTENSIONS.get(content_type.partition(";")[0].strip().lower())
+
+
+def download_images(
+    img_urls: List[str],
+    filepath: str,
+    max_workers: int = DOWNLOAD_MAX_WORKERS,
+    keep_format: bool = False,
+    etags: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """Download images from list of urls concurrently, downloaded images are encoded while the rest is downloading
+
+    With keep_format, png, jpeg and webp images are saved in their original format without any re-encoding.
+    With etags (img_url -> ETag stored with the already scraped image), unchanged images are not downloaded
+    again, the server answers the conditional request with 304 Not Modified and no body.
+    Returns ETags of the downloaded images, to be stored in metadata of the uploaded files.
+    """
+    etags = etags or {}
+    downloaded_etags = {}
+    encodings = []
+    # Downloads wait while this many images are waiting for encoding, so the images do not pile up in memory
+    encoding_slots = threading.BoundedSemaphore(2 * (os.cpu_count() or 1))
+
+    def download_image(i: int, img_url: str) -> bool:
+        headers = {"If-None-Match": etags[img_url]} if img_url in etags else None
+        r = http_session().get(img_url, headers=headers, timeout=WAIT)
+        if r.status_code == 304:  # not modified since it was scraped
+            return False
+        r.raise_for_status()
+        if r.headers.get("ETag"):
+            downloaded_etags[img_url] = r.headers["ETag"]
+        extension = content_type_to_img_extension(r.headers.get("Content-Type", "")) if keep_format else None
+        if image_needs_encoding(r.content, extension):
+            encoding_slots.acquire()
+            encoding = image_encoding_executor().submit(encode_image, r.content, f"{filepath}_{i}")
+            encoding.add_done_callback(lambda _: encoding_slots.release())
+            encodings.append(encoding)
+        else:  # written right away by the download thread
+            save_image(r.content, f"{filepath}_{i}", extension)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded = list(executor.map(download_image, range(len(img_urls)), img_urls))
+    for encoding in encodings:
+        encoding.result()
+    logger.info(f"Downloaded {sum(downloaded)} images, {len(downloaded) - sum(downloaded)} were not modified.")
+    return downloaded_etags
+
+
+async def download_images_async(
+    img_urls: List[str],
+    filepath: str,
+    concurrency: int = DOWNLOAD_CONCURRENCY,
+    keep_format: bool = False,
+    etags: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """Download images from list of urls on a single event loop, async counterpart of download_images
+
+    Up to `concurrency` requests are in flight over a shared connection pool without a thread per download,
+    which pays off for very large lists of urls. Images are encoded in the image encoding executor meanwhile.
+    """
+    etags = etags or {}
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    downloaded_etags = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=3)
+
+    async with httpx.AsyncClient(transport=transport, timeout=WAIT, follow_redirects=True) as client:
+
+        async def download_image(i: int, img_url: str) -> bool:
+            headers = {"If-None-Match": etags[img_url]} if img_url in etags else None
+            # The slot is held until the image is saved, so at most `concurrency` images are held in memory
+            async with semaphore:
+                r = await client.get(img_url, headers=headers)
+                if r.status_code == 304:  # not modified since it was scraped
+                    return False
+                r.raise_for_status()
+                if r.headers.get("ETag"):
+                    downloaded_etags[img_url] = r.headers["ETag"]
+                extension = content_type_to_img_extension(r.headers.get("Content-Type", "")) if keep_format else None
+                if image_needs_encoding(r.content, extension):
+                    await loop.run_in_executor(image_encoding_executor(), encode_image, r.content, f"{filepath}_{i}")
+                else:
+                    await asyncio.to_thread(save_image, r.content, f"{filepath}_{i}", extension)
+            return True
+
+        # All the downloads finish before the client is closed, even when some of them fail
+        results = await asyncio.gather(
+            *(download_image(i, img_url) for i, img_url in enumerate(img_urls)), return_exceptions=True
+        )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.warning(f"{len(errors)} of {len(img_urls)} images were not downloaded!")
+        raise errors[0]
+    logger.info(f"Downloaded {sum(results)} images, {len(results) - sum(results)} were not modified.")
+    return downloaded_etags
+
+
+def filter_new_urls(urls: Iterable[str], seen_urls: ScalableBloomFilter) -> List[str]:
+    """Return canonical urls which were not seen yet and add them to the seen ones
+
+    A bloom filter has no false negatives, so a url is never written twice. A false positive
+    (probability URL_FILTER_ERROR_RATE) drops a new url, which is an accepted loss for the memory saved.
+    """
+    return [url for url in map(canonicalize_url, urls) if not seen_urls.add(url)]
+
+
+# Item ids of the jsonl files in storage keyed by their url and the id extraction mode (parse_json),
+# with ETag of the file they were read from.
+# Warm Lambda invocations reuse them while the file is unchanged, frozen as they are shared by all the callers.
+_ITEM_IDS_CACHE: Dict[str, Tuple[str, FrozenSet[str]]] = {}
+
+
+def extract_item_ids(lines: Iterable[bytes], parse_json: bool = False) -> FrozenSet[str]:
+    """Extracts item ids from jsonl lines by a regex search, without parsing the whole records
+
+    The first "id" key of a line is taken and its value must be a plain string or number. Records where it may
+    contain escapes or where a nested "id" comes first need parse_json, which parses every line fully.
+    """
+    if parse_json:
+        return frozenset(str(json_loads(line)["id"]) for line in lines if line.strip())
+    matches = (ITEM_ID_PATTERN.search(line) for line in lines)
+    return frozenset(match.group(1).decode("utf-8") for match in matches if match)
+
+
+def read_item_ids_from_jsonl(file: str, parse_json: bool = False) -> FrozenSet[str]:
     assert file.endswith(".jsonl")
 
-    with open(file) as fr:
-        return {json.loads(line)["id"] for line in fr}
+    with open(file, "rb") as fr:
+        return extract_item_ids(fr, parse_json=parse_json)
 
 
 # URLs operations
@@ -64,14 +430,41 @@ def item_url_to_path(item_url: str, home_url: str = HOME_URL) -> str:
         In: https://www.vinted.cz/zeny/obleceni/saty/mini-saty/2353299058-deezee-bezove-saty
         Out: zeny/obleceni/saty/mini-saty
     """
-    return "/".join(item_url.replace(home_url, "").split("/")[:-1])
+    tail = item_url[len(home_url):] if item_url.startswith(home_url) else item_url
+    return tail.rpartition("/")[0]
+
+
+def item_url_to_id(item_url: str) -> str:
+    """Extracts item id from item url, a single scan without intermediate lists
+
+    Example:
+        In: https://www.vinted.cz/zeny/obleceni/saty/mini-saty/2353299058-deezee-bezove-saty
+        Out: 2353299058
+    """
+    return item_url.rpartition("/")[2].partition("-")[0]
 
 
-def item_url_to_img_path(item_url: str, prefix: str = "data/item_data/images", numbered: bool = False) -> str:
+def item_url_to_img_path(
+    item_url: str, prefix: str = "data/item_data/images", numbered: bool = False, extension: str = "png"
+) -> str:
     """Convert item_url to expected image path"""
-    item_id = item_url.split("/")[-1].split("-")[0]
-    img_filepath = os.path.join(prefix, item_url_to_path(item_url, HOME_URL), f"{item_id}.png")
-    return img_filepath.replace(".png", "_0.png") if numbered else img_filepath
+    tail = item_url[len(HOME_URL):] if item_url.startswith(HOME_URL) else item_url
+    path, _, slug = tail.rpartition("/")
+    item_id = item_url_to_id(slug)
+    img_name = f"{item_id}_0.{extension}" if numbered else f"{item_id}.{extension}"
+    # Object keys are always "/" separated, so the path is formatted directly instead of os.path.join
+    return f"{prefix}/{path}/{img_name}" if path else f"{prefix}/{img_name}"
+
+
+def canonicalize_url(url: str) -> str:
+    """Drop query and fragment, lowercase host and strip trailing slash, so variants of the same url match
+
+    Example:
+        In: https://www.Vinted.cz/zeny/obleceni/saty/2353299058-deezee-bezove-saty/?referrer=catalog
+        Out: https://www.vinted.cz/zeny/obleceni/saty/2353299058-deezee-bezove-saty
+    """
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc.lower()}{parts.path.rstrip('/')}"
 
 
 def construct_starting_urls(args: argparse.Namespace) -> List[str]:
@@ -80,41 +473,112 @@ def construct_starting_urls(args: argparse.Namespace) -> List[str]:
 
 
 def remove_duplicate_urls_from_file(filepath: str) -> None:
-    urls = read_urls_from_file(filepath)
-    unique_urls = set(urls)
-    with open(filepath, "w") as fw:
-        fw.write("\n".join(unique_urls))
-    logger.info(f"Removed duplicates from the file with urls. Before {len(urls)} - after {len(unique_urls)}")
-
+    """Remove duplicate urls from the file in a single pass, keeping the first occurrence of every url
 
-def filter_already_scraped_item_urls(item_urls: List[str]) -> List[str]:
+    Only 64-bit hashes of the seen urls are kept in memory, not the urls themselves.
+    """
+    seen_hashes = set()
+    total_urls = 0
+    tmp_filepath = f"{filepath}.tmp"
+    with open(filepath, "r", encoding="utf-8") as fr, open(tmp_filepath, "w", encoding="utf-8") as fw:
+        for line in fr:
+            url = line.strip()
+            if not url:
+                continue
+            total_urls += 1
+            url_hash = xxhash.xxh3_64_intdigest(url)
+            if url_hash not in seen_hashes:
+                seen_hashes.add(url_hash)
+                fw.write(f"{url}\n")
+    os.replace(tmp_filepath, filepath)
+    logger.info(f"Removed duplicates from the file with urls. Before {total_urls} - after {len(seen_hashes)}")
+
+
+def filter_already_scraped_item_urls(item_urls: List[str], extensions: Tuple[str, ...] = ("png",)) -> List[str]:
     logger.info("Filtering out already scraped items.")
     scraped_item_ids = gcs_read_item_ids_from_jsonl(ITEM_DATA_ALL)
     logger.info(f"Found {len(scraped_item_ids)} already scraped items")
 
-    non_scraped_item_urls = []
-    for item_url in item_urls:
-        item_id = item_url.split("/")[-1].split("-")[0]
-        # item doesn't have image or data scraped
-        if not gcs_item_url_img_exists(item_url) or not (item_id in scraped_item_ids):
-            non_scraped_item_urls.append(item_url)
-    return non_scraped_item_urls
+    # Images need to be checked only for items with already scraped data, the rest is scraped anyway
+    scraped_item_urls = [item_url for item_url in item_urls if item_url_to_id(item_url) in scraped_item_ids]
+    if len(scraped_item_urls) <= IMG_EXISTS_MAX_CHECKS:
+        img_exists = gcs_images_exist_batch(scraped_item_urls, extensions=extensions)
+    else:
+        existing_img_paths = gcs_get_existing_img_paths(scraped_item_urls)
+        img_exists = {
+            item_url: any(
+                item_url_to_img_path(item_url, numbered=True, extension=extension) in existing_img_paths
+                for extension in extensions
+            )
+            for item_url in scraped_item_urls
+        }
+    logger.info(f"Found {sum(img_exists.values())} already scraped images")
+
+    # item doesn't have image or data scraped
+    return [item_url for item_url in item_urls if not img_exists.get(item_url, False)]
+
+
+def item_urls_to_img_prefixes(item_urls: List[str]) -> Set[str]:
+    """Returns image directories (with trailing slash) of given item urls, so they can be listed at once"""
+    return {posixpath.dirname(item_url_to_img_path(item_url)) + "/" for item_url in item_urls}
+
+
+def get_last_item_url_filepaths(site: str, categories: List[str], file_names: Iterable[str]) -> List[Optional[str]]:
+    """Returns last item_url filepath for every category (None if it has no files), in the order of categories
+
+    File names are consumed in a single pass.
+    """
+    latest_datetimes = dict.fromkeys(categories, "")
+    for file_name in file_names:
+        *_, category, base_name = file_name.split("/")
+        if category not in latest_datetimes:
+            continue
+        file_datetime = base_name.split("_")[2].rstrip(".txt")
+        if file_datetime > latest_datetimes[category]:
+            latest_datetimes[category] = file_datetime
+    missing_categories = [category for category, file_datetime in latest_datetimes.items() if not file_datetime]
+    if missing_categories:
+        logger.warning(f"No item_url files found for {site} {missing_categories}.")
+    return [
+        f"data/item_urls/{site}/{category}/item_urls_{latest_datetimes[category]}.txt"
+        if latest_datetimes[category]
+        else None
+        for category in categories
+    ]
 
 
 # GCS operations
-def gcs_upload_file(source_file_name: str, destination_file_name: str):
-    """Uploads a file to the GCS bucket"""
-    storage_client = storage.Client(GCP_PROJECT)
-    bucket = storage_client.bucket(GCS_STORAGE)
+GCS_UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024  # must be a multiple of 256 KiB
+GCS_UPLOAD_TIMEOUT = 120
+
+
+@lru_cache(maxsize=1)
+def gcs_client() -> storage.Client:
+    """Returns GCS client shared by the GCS operations"""
+    return storage.Client(GCP_PROJECT)
+
+
+@lru_cache(maxsize=1)
+def gcs_bucket() -> storage.Bucket:
+    """Returns GCS bucket shared by the GCS operations (no request is made)"""
+    return gcs_client().bucket(GCS_STORAGE)
+
+
+def gcs_upload_file(source_file_name: str, destination_file_name: str, metadata: Optional[Dict[str, str]] = None):
+    """Uploads a file to the GCS bucket, optionally with custom metadata (e.g. SOURCE_ETAG_KEY)"""
+    bucket = gcs_bucket()
     blob = bucket.blob(destination_file_name)
-    blob.upload_from_filename(source_file_name)
+    blob.metadata = metadata
+    if os.path.getsize(source_file_name) > GCS_UPLOAD_CHUNK_SIZE:
+        # Resumable upload in chunks, a failed chunk is retried instead of the whole file
+        blob.chunk_size = GCS_UPLOAD_CHUNK_SIZE
+    blob.upload_from_filename(source_file_name, timeout=GCS_UPLOAD_TIMEOUT, checksum="crc32c")
     logger.info(f"File {source_file_name} uploaded to {destination_file_name}.")
 
 
 def gcs_upload_file_from_variale(source_variable: str, destination_file_name: str):
     """Uploads variable to a file in the GCS bucket"""
-    storage_client = storage.Client(GCP_PROJECT)
-    bucket = storage_client.bucket(GCS_STORAGE)
+    bucket = gcs_bucket()
     blob = bucket.blob(destination_file_name)
     blob.upload_from_string(source_variable)
     logger.info(f"{destination_file_name} uploaded to {destination_file_name}.")
@@ -122,7 +586,7 @@ def gcs_upload_file_from_variale(source_variable: str, destination_file_name: st
 
 def gcs_get_categories_from_item_url_files(site: str) -> List[str]:
     """Returns list of categories (e.g. ['muzi', 'zeny'] extracted from directory and file structure in GCS"""
-    storage_client = storage.Client(GCP_PROJECT)
+    storage_client = gcs_client()
     prefix = f"data/item_urls/{site}/"
     url_files = [i.name.replace(prefix, "") for i in storage_client.list_blobs(GCS_STORAGE, prefix=prefix)]
     categories = list(set(map(lambda x: x.split("/")[0], url_files)))
@@ -133,83 +597,156 @@ def gcs_get_all_item_url_filepaths(site: str, categories: List[str]) -> List[str
     """Returns all item_url filepaths for given site and category"""
     logger.info(f"Retrieving all item_url files for {site} {categories}.")
     assert isinstance(categories, list), f"Categories are expected to be a list and not a {type(categories)}."
-    storage_client = storage.Client(GCP_PROJECT)
-    all_file_names = []
-    for category in categories:
+
+    def list_category(category: str) -> List[str]:
         prefix = f"data/item_urls/{site}/{category}/"
-        all_file_names.extend([i.name for i in storage_client.list_blobs(GCS_STORAGE, prefix=prefix)])
+        return [i.name for i in gcs_client().list_blobs(GCS_STORAGE, prefix=prefix)]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(categories)))) as executor:
+        all_file_names = list(chain.from_iterable(executor.map(list_category, categories)))
     logger.info(f"Retrieved filepaths: {all_file_names}.")
     return all_file_names
 
 
-def gcs_get_last_item_url_filepath(site: str, categories: List[str]) -> List[str]:
-    """Returns last item_url filepath for given site and category"""
+def gcs_get_last_item_url_filepath(site: str, categories: List[str]) -> List[Optional[str]]:
+    """Returns last item_url filepath for given site and category, None for a category without any files"""
     logger.info(f"Retrieving last item_url files for {site} {categories}.")
-    latest_files = []
-    for category in categories:
-        prefix = f"data/item_urls/{site}/{category}/"
-        file_names = gcs_get_all_item_url_filepaths(site, [category])
-        latest_datetime = sorted([i.split("/")[-1].split("_")[2].rstrip(".txt") for i in file_names])[-1]
-        latest_files.append(os.path.join(prefix, f"item_urls_{latest_datetime}.txt"))
+    # Single listing of all the categories, keys are streamed page by page
+    file_names = (blob.name for blob in gcs_client().list_blobs(GCS_STORAGE, prefix=f"data/item_urls/{site}/"))
+    latest_files = get_last_item_url_filepaths(site, categories, file_names)
     logger.info(f"Retrieved filepaths: {latest_files}.")
     return latest_files
 
 
 def gcs_get_item_urls_from_filepaths(filepaths: List[str]) -> List[str]:
     """Returns content from item-url filepaths given as argument"""
-    storage_client = storage.Client(GCP_PROJECT)
-    bucket = storage_client.get_bucket(GCS_STORAGE)
+    bucket = gcs_bucket()
+
+    def read_urls(filepath: str) -> Set[str]:
+        with bucket.blob(filepath).open("r", encoding="utf-8") as fr:
+            return {url for url in map(str.strip, fr) if url}
 
     merged_urls = set()
-    for filepath in filepaths:
-        blob = bucket.get_blob(filepath)
-        blob_text = blob.download_as_string().decode("utf-8")
-        merged_urls.update(set(blob_text.split("\n")))
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(filepaths)))) as executor:
+        # Files are merged as soon as they are read, a slow file does not hold the others in memory
+        for read in as_completed([executor.submit(read_urls, filepath) for filepath in filepaths]):
+            merged_urls.update(read.result())
     logger.info(f"Retrieved {len(merged_urls)}.")
     return list(merged_urls)
 
 
-def gcs_item_url_img_exists(item_url: str) -> bool:
-    """Checks if images are scraped for given item_url"""
-    storage_client = storage.Client(GCP_PROJECT)
-    bucket = storage_client.bucket(GCS_STORAGE)
-    img_filepath = item_url_to_img_path(item_url, numbered=True)
-    return storage.Blob(bucket=bucket, name=img_filepath).exists(storage_client)
+def gcs_item_url_img_exists(item_url: str, extensions: Tuple[str, ...] = ("png",)) -> bool:
+    """Checks if images are scraped for given item_url, in any of the given formats"""
+    storage_client = gcs_client()
+    bucket = gcs_bucket()
+    img_filepaths = [item_url_to_img_path(item_url, numbered=True, extension=extension) for extension in extensions]
+    return any(storage.Blob(bucket=bucket, name=img_filepath).exists(storage_client) for img_filepath in img_filepaths)
+
+
+def gcs_get_existing_img_paths(item_urls: List[str]) -> Set[str]:
+    """Returns image paths in GCS for directories of given item urls, one listing per directory"""
+    storage_client = gcs_client()
+    return {
+        blob.name
+        for prefix in item_urls_to_img_prefixes(item_urls)
+        for blob in storage_client.list_blobs(GCS_STORAGE, prefix=prefix)
+    }
+
+
+def gcs_images_exist_batch(
+    item_urls: List[str], max_workers: int = IMG_EXISTS_MAX_WORKERS, extensions: Tuple[str, ...] = ("png",)
+) -> Dict[str, bool]:
+    """Checks if images are scraped for given item_urls, the requests run concurrently"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(item_urls, executor.map(partial(gcs_item_url_img_exists, extensions=extensions), item_urls)))
+
+
+def gcs_get_source_etag(file: str) -> Optional[str]:
+    """Returns ETag of the source the file was downloaded from, None if the file or the ETag is missing"""
+    blob = gcs_bucket().get_blob(file)
+    return (blob.metadata or {}).get(SOURCE_ETAG_KEY) if blob else None
 
 
 def gcs_file_exists(file: str) -> bool:
     """Checks if images are scraped for given item_url"""
-    storage_client = storage.Client(GCP_PROJECT)
-    bucket = storage_client.bucket(GCS_STORAGE)
+    storage_client = gcs_client()
+    bucket = gcs_bucket()
     return storage.Blob(bucket=bucket, name=file).exists(storage_client)
 
 
-def gcs_read_item_ids_from_jsonl(file: str) -> Set[str]:
+def gcs_read_item_ids_from_jsonl(file: str, parse_json: bool = False) -> FrozenSet[str]:
     """Reads all the item ids from jsonl file from GCS"""
     assert file.endswith(".jsonl")
-    if gcs_file_exists(file):
-        storage_client = storage.Client(GCP_PROJECT)
-        bucket = storage_client.get_bucket(GCS_STORAGE)
-        blob = bucket.get_blob(file)
-        blob_text = blob.download_as_string().decode("utf-8")
-        return {json.loads(line)["id"] for line in blob_text.split("\n")}
-    return set()
+    blob = gcs_bucket().get_blob(file)
+    if blob is None:
+        return frozenset()
+    cache_key = f"gs://{GCS_STORAGE}/{file}#{parse_json}"
+    if cache_key in _ITEM_IDS_CACHE and _ITEM_IDS_CACHE[cache_key][0] == blob.etag:
+        logger.info(f"File {file} has not changed, reusing its cached item ids.")
+        return _ITEM_IDS_CACHE[cache_key][1]
+    # Stream the blob line by line, the whole file is never held in memory
+    with blob.open("rb") as fr:
+        item_ids = extract_item_ids(fr, parse_json=parse_json)
+    _ITEM_IDS_CACHE[cache_key] = (blob.etag, item_ids)
+    return item_ids
 
 
 # Amazon S3 operations
-def s3_upload_file(source_file_name: str, destination_file_name: str, bucket: str = S3_BUCKET):
-    """Uploads a file to the S3 bucket"""
-    s3 = boto3.client('s3')
-    s3.upload_file(source_file_name, bucket, destination_file_name)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=32 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+
+@lru_cache(maxsize=1)
+def s3_client():
+    """Returns S3 client shared by the S3 operations (boto3 clients are thread-safe)"""
+    return boto3.client('s3')
+
+
+def s3_upload_file(
+    source_file_name: str,
+    destination_file_name: str,
+    bucket: str = S3_BUCKET,
+    metadata: Optional[Dict[str, str]] = None,
+):
+    """Uploads a file to the S3 bucket, optionally with custom metadata (e.g. SOURCE_ETAG_KEY)"""
+    extra_args = {'Metadata': metadata} if metadata else None
+    s3_client().upload_file(
+        source_file_name, bucket, destination_file_name, ExtraArgs=extra_args, Config=S3_TRANSFER_CONFIG
+    )
     logger.info(f"File {source_file_name} uploaded to {destination_file_name}.")
 
 
+def s3_upload_files(files: List[Tuple[str, str]], bucket: str = S3_BUCKET):
+    """Uploads (source, destination) file pairs to the S3 bucket concurrently"""
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        list(executor.map(lambda file: s3_upload_file(*file, bucket=bucket), files))
+
+
+def s3_list_keys(prefix: str, bucket: str = S3_BUCKET) -> Iterator[str]:
+    """Yields all keys under the prefix, list_objects_v2 pages are fetched lazily (a single call stops at 1000 keys)"""
+    paginator = s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
 def s3_get_categories_from_item_url_files(site: str) -> List[str]:
     """Returns list of categories (e.g. ['muzi', 'zeny'] extracted from directory and file structure in S3"""
-    s3 = boto3.client('s3')
     prefix = f"data/item_urls/{site}/"
-    url_files = [obj['Key'].replace(prefix, '') for obj in s3.list_objects(Bucket=S3_BUCKET, Prefix=prefix)['Contents']]
-    categories = list(set(map(lambda x: x.split("/")[0], url_files)))
+    paginator = s3_client().get_paginator('list_objects_v2')
+    # Only the category "directories" are listed, not every item_url file in them
+    pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix, Delimiter='/', PaginationConfig={'PageSize': 1000})
+    categories = [
+        common_prefix['Prefix'][len(prefix):].rstrip('/')
+        for page in pages
+        for common_prefix in page.get('CommonPrefixes', [])
+    ]
     return categories
 
 
@@ -217,61 +754,106 @@ def s3_get_all_item_url_filepaths(site: str, categories: List[str]) -> List[str]
     """Returns all item_url filepaths for given site and category"""
     logger.info(f"Retrieving all item_url files for {site} {categories}.")
     assert isinstance(categories, list), f"Categories are expected to be a list and not a {type(categories)}."
-    s3 = boto3.client('s3')
-    all_file_names = []
-    for category in categories:
+
+    def list_category(category: str) -> List[str]:
         prefix = f"data/item_urls/{site}/{category}/"
-        all_file_names.extend([obj['Key'] for obj in s3.list_objects(Bucket=S3_BUCKET, Prefix=prefix)['Contents']])
+        return list(s3_list_keys(prefix))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(categories)))) as executor:
+        all_file_names = list(chain.from_iterable(executor.map(list_category, categories)))
     logger.info(f"Retrieved filepaths: {all_file_names}.")
     return all_file_names
 
 
-def s3_get_last_item_url_filepath(site: str, categories: List[str]) -> List[str]:
-    """Returns last item_url filepath for given site and category"""
+def s3_get_last_item_url_filepath(site: str, categories: List[str]) -> List[Optional[str]]:
+    """Returns last item_url filepath for given site and category, None for a category without any files"""
     logger.info(f"Retrieving last item_url files for {site} {categories}.")
-    latest_files = []
-    for category in categories:
-        prefix = f"data/item_urls/{site}/{category}/"
-        file_names = s3_get_all_item_url_filepaths(site, [category])
-        latest_datetime = sorted([i.split("/")[-1].split("_")[2].rstrip(".txt") for i in file_names])[-1]
-        latest_files.append(os.path.join(prefix, f"item_urls_{latest_datetime}.txt"))
+    # Single listing of all the categories, keys are streamed page by page
+    file_names = s3_list_keys(f"data/item_urls/{site}/")
+    latest_files = get_last_item_url_filepaths(site, categories, file_names)
     logger.info(f"Retrieved filepaths: {latest_files}.")
     return latest_files
 
 
 def s3_get_item_urls_from_filepaths(filepaths: List[str]) -> List[str]:
     """Returns content from item-url filepaths given as argument"""
-    s3 = boto3.resource('s3')
+
+    def read_urls(filepath: str) -> Set[str]:
+        lines = s3_client().get_object(Bucket=S3_BUCKET, Key=filepath)['Body'].iter_lines(chunk_size=1024 * 1024)
+        return {url.decode('utf-8') for url in map(bytes.strip, lines) if url}
+
     merged_urls = set()
-    for filepath in filepaths:
-        obj = s3.Object(S3_BUCKET, filepath)
-        obj = obj.get()['Body'].read().decode('utf-8')
-        merged_urls.update(set(obj.split("\n")))
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(filepaths)))) as executor:
+        # Files are merged as soon as they are read, a slow file does not hold the others in memory
+        for read in as_completed([executor.submit(read_urls, filepath) for filepath in filepaths]):
+            merged_urls.update(read.result())
     logger.info(f"Retrieved {len(merged_urls)}.")
     return list(merged_urls)
 
 
-def s3_item_url_img_exists(item_url: str) -> bool:
-    """Checks if images are scraped for given item_url"""
-    s3_client = boto3.client('s3')
-    img_filepath = item_url_to_img_path(item_url, numbered=True)
-    objects = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=img_filepath, MaxKeys=1)
-    return 'Contents' in objects
+def s3_item_url_img_exists(item_url: str, extensions: Tuple[str, ...] = ('png',)) -> bool:
+    """Checks if images are scraped for given item_url, in any of the given formats"""
+    return any(
+        s3_file_exists(item_url_to_img_path(item_url, numbered=True, extension=extension)) for extension in extensions
+    )
 
 
-def s3_file_exists(file: str) -> bool:
-    """Checks if images are scraped for given item_url"""
-    s3_client = boto3.client('s3')
-    objects = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=file, MaxKeys=1)
-    return 'Contents' in objects
+def s3_get_existing_img_paths(item_urls: List[str]) -> Set[str]:
+    """Returns image paths in S3 for directories of given item urls, one paginated listing per directory"""
+    return {key for prefix in item_urls_to_img_prefixes(item_urls) for key in s3_list_keys(prefix)}
+
+
+def s3_images_exist_batch(
+    item_urls: List[str], max_workers: int = IMG_EXISTS_MAX_WORKERS, extensions: Tuple[str, ...] = ('png',)
+) -> Dict[str, bool]:
+    """Checks if images are scraped for given item_urls, the requests run concurrently"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(item_urls, executor.map(partial(s3_item_url_img_exists, extensions=extensions), item_urls)))
+
+
+def s3_file_exists(file: str, bucket: str = S3_BUCKET) -> bool:
+    """Checks if the exact key exists, HEAD request is cheaper and faster than listing"""
+    try:
+        s3_client().head_object(Bucket=bucket, Key=file)
+        return True
+    except ClientError as E:
+        if s3_is_not_found(E):
+            return False
+        raise
+
+
+def s3_is_not_found(error: ClientError) -> bool:
+    """Checks if the client error means that the key does not exist"""
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+
+def s3_get_source_etag(file: str, bucket: str = S3_BUCKET) -> Optional[str]:
+    """Returns ETag of the source the file was downloaded from, None if the file or the ETag is missing"""
+    try:
+        return s3_client().head_object(Bucket=bucket, Key=file)['Metadata'].get(SOURCE_ETAG_KEY)
+    except ClientError as E:
+        if s3_is_not_found(E):
+            return None
+        raise
 
 
-def s3_read_item_ids_from_jsonl(file: str) -> Set[str]:
+def s3_read_item_ids_from_jsonl(file: str, parse_json: bool = False) -> FrozenSet[str]:
     """Reads all the item ids from jsonl file from S3"""
     assert file.endswith(".jsonl")
-    if s3_file_exists(file):
-        s3 = boto3.resource('s3')
-        obj = s3.Object(S3_BUCKET, file)
-        obj = obj.get()['Body'].read().decode('utf-8')
-        return {json.loads(line)["id"] for line in obj.split("\n")}
-    return set()
+    cache_key = f"s3://{S3_BUCKET}/{file}#{parse_json}"
+    cached_etag, cached_item_ids = _ITEM_IDS_CACHE.get(cache_key, (None, None))
+    try:
+        # Conditional GET, unchanged file is answered by 304 without the body
+        condition = {'IfNoneMatch': cached_etag} if cached_etag else {}
+        obj = s3_client().get_object(Bucket=S3_BUCKET, Key=file, **condition)
+    except ClientError as E:
+        if E.response['Error']['Code'] == '304':
+            logger.info(f"File {file} has not changed, reusing its cached item ids.")
+            return cached_item_ids
+        if s3_is_not_found(E):
+            return frozenset()
+        raise
+    lines = obj['Body'].iter_lines(chunk_size=1024 * 1024)
+    item_ids = extract_item_ids(lines, parse_json=parse_json)
+    _ITEM_IDS_CACHE[cache_key] = (obj['ETag'], item_ids)
+    return item_ids
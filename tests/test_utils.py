@@ -0,0 +1,14 @@
+import pytest
+
+utils = pytest.importorskip("src.utils")
+
+
+def test_extract_item_ids_regex_matches_json_parse():
+    lines = [
+        b'{"id": "2353299058", "title": "Deezee bezove saty"}\n',
+        b'{"id":42,"price":"150.0"}\n',
+        b'{"title": "Saty", "id" : "7"}\n',
+        b"\n",
+    ]
+    assert utils.extract_item_ids(lines) == utils.extract_item_ids(lines, parse_json=True)
+    assert utils.extract_item_ids(lines) == {"2353299058", "42", "7"}